@@ -5,28 +5,29 @@ from tqdm import tqdm
 from utils.dice_score import multiclass_dice_coeff, dice_coeff
 
 
-def evaluate(net, dataloader, device):
+def evaluate(net, dataloader, device, amp=False, amp_dtype=torch.bfloat16):
     net.eval()
     num_val_batches = len(dataloader)
     final_score = 0
 
-    # iterate over the validation set
-    for batch in tqdm(dataloader, total=num_val_batches, desc='Validation round', unit='batch', leave=False):
-        count = 0
-        image, true_out = batch['image'], batch['output']
-        # move images and labels to correct device and type
-        image = image.to(device=device, dtype=torch.float32)
-        true_out = true_out.to(device=device, dtype=torch.float32)
-
-        with torch.no_grad():
-            # predict the mask
-            pred = net(image)
-            print(pred, true_out)
+    # iterate over the validation set, inference_mode also skips autograd's version counter bookkeeping
+    with torch.inference_mode():
+        for batch in tqdm(dataloader, total=num_val_batches, desc='Validation round', unit='batch', leave=False):
+            count = 0
+            image, true_out = batch['image'], batch['output']
+            # move images and labels to correct device and type, same channels_last layout as in training
+            image = image.to(device=device, non_blocking=False).permute(0, 3, 1, 2).float().div_(255)
+            image = image.contiguous(memory_format=torch.channels_last)
+            true_out = true_out.to(device=device, dtype=torch.float32, non_blocking=False)
+
+            with torch.autocast('cuda', dtype=amp_dtype, enabled=amp):
+                # predict the mask
+                pred = torch.sigmoid(net(image))
             for i in range(0, len(pred)):
                 if torch.ceil(pred[i][0]) == torch.ceil(true_out[i][0]):
                     count += 1
-        
-        final_score += count/len(batch)
+
+            final_score += count/len(batch)
 
            
 
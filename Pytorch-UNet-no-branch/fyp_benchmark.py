@@ -42,7 +42,7 @@ def benchmark(model):
         img = img.to(device=device, dtype=torch.float32)
         with torch.no_grad():
             # predict the mask
-            mask_pred = net(img)
+            mask_pred = torch.sigmoid(net(img))
             #print(mask_pred)
             total_img +=1
             if mask_pred >0.5:
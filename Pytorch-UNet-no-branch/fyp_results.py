@@ -65,7 +65,7 @@ for file_name in selected_imgs:
     else:
         true_out = 0.0
         
-    pred = net(img)
+    pred = torch.sigmoid(net(img))
     pred = torch.round(pred[0][0])
     pred = pred.detach().numpy()
     
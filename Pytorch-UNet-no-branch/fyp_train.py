@@ -1,17 +1,26 @@
 import argparse
+import atexit
 import logging
+import os
+import random
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import timedelta
 from pathlib import Path
 
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
 import wandb
 from torch import optim
-from torch.utils.data import DataLoader, random_split
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm
 
-from utils.data_loading import BasicDataset, CarvanaDataset
+from utils.data_loading import BasicDataset, CachedDataset, CarvanaDataset, CUDAPrefetcher
 from utils.dice_score import dice_loss
 from evaluate import evaluate
 from unet import UNet
@@ -27,43 +36,149 @@ dir_mask_testing = Path('../dfdc_deepfake_challenge/dataset_new_1/testing/masks/
 dir_checkpoint = Path('./checkpoints/')
 
 
+def load_dataset(images_dir, masks_dir, img_scale: float = 1.0):
+    try:
+        return CarvanaDataset(images_dir, masks_dir, img_scale)
+    except (AssertionError, RuntimeError):
+        return BasicDataset(images_dir, masks_dir, img_scale)
+
+
+def load_cached_dataset(memmap_path, images_dir, masks_dir, img_scale: float = 1.0):
+    # decode the crops only on the first run, later runs just map the existing file
+    if not dist.is_initialized():
+        if not memmap_path.exists():
+            CachedDataset.build(load_dataset(images_dir, masks_dir, img_scale), memmap_path)
+        return CachedDataset(memmap_path)
+
+    # the other ranks wait here while rank 0 decodes the whole crop set, far longer than NCCL's default
+    # timeout; a separate gloo group gets the long timeout so training keeps the default one
+    cache_group = dist.new_group(backend='gloo', timeout=timedelta(hours=6))
+    error = None
+    if dist.get_rank() == 0 and not memmap_path.exists():
+        try:
+            CachedDataset.build(load_dataset(images_dir, masks_dir, img_scale), memmap_path)
+        except Exception as e:
+            error = e
+
+    # rank 0 tells everyone whether the build worked, so a failure stops all ranks instead of leaving them waiting
+    status = [None if error is None else repr(error)]
+    dist.broadcast_object_list(status, src=0, group=cache_group)
+    dist.destroy_process_group(cache_group)
+    if error is not None:
+        raise error
+    if status[0] is not None:
+        raise RuntimeError(f'Rank 0 failed to build the crop cache {memmap_path}: {status[0]}')
+
+    return CachedDataset(memmap_path)
+
+
+class NoOpExperiment:
+    """Stands in for the wandb run on DDP ranks > 0 or when wandb can't be initialised"""
+
+    def __init__(self):
+        self.config = {}
+
+    def log(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+class BufferedExperiment:
+    """Collects log entries and only sends them to the wrapped wandb run on flush()"""
+
+    def __init__(self, experiment):
+        self.experiment = experiment
+        self.config = experiment.config
+        self.buffer = []
+
+    def log(self, data):
+        self.buffer.append(data)
+
+    def flush(self):
+        for data in self.buffer:
+            self.experiment.log(data)
+        self.buffer.clear()
+
+
+def init_experiment(is_main_process, config):
+    if not is_main_process:
+        return NoOpExperiment()
+
+    try:
+        # give up quickly on a dead network instead of stalling startup for wandb's default timeout
+        experiment = wandb.init(project='U-Net', reinit=True, anonymous='must', entity="sravanchittupalli",
+                                settings=wandb.Settings(init_timeout=30))
+        experiment.config.update(config)
+    except Exception as e:
+        logging.warning(f'Could not initialise wandb, training without experiment logging: {e}')
+        return NoOpExperiment()
+
+    experiment = BufferedExperiment(experiment)
+    # still send whatever is buffered if training is interrupted (runs before wandb's own exit hook)
+    atexit.register(experiment.flush)
+    return experiment
+
+
+def save_state_dict(state_dict, path, epoch):
+    torch.save(state_dict, str(path))
+    logging.info(f'Checkpoint {epoch} saved!')
+
+
 # +
 def train_net(net,
               device,
+              train_set,
+              val_set,
               epochs: int = 20,
               batch_size: int = 32,
               learning_rate: float = 0.001,
               val_percent: float = 0.1,
               save_checkpoint: bool = True,
               img_scale: float = 1.0,
-              amp: bool = False):
-    # 1. Create dataset
-    try:
-        dataset_training = CarvanaDataset(dir_img_training, dir_mask_training, img_scale)
-    except (AssertionError, RuntimeError):
-        dataset_training = BasicDataset(dir_img_training, dir_mask_training, img_scale)
-        
-    try:
-        dataset_testing = CarvanaDataset(dir_img_testing, dir_mask_testing, img_scale)
-    except (AssertionError, RuntimeError):
-        dataset_testing = BasicDataset(dir_img_testing, dir_mask_testing, img_scale)
-
-    # 2. Split into train / validation partitions
-    n_val = len(dataset_testing)
-    n_train = len(dataset_training)
-    train_set, _ = random_split(dataset_training, [n_train, 0], generator=torch.Generator().manual_seed(0))
-    _, val_set = random_split(dataset_testing, [0, n_val], generator=torch.Generator().manual_seed(0))
-
-    # 3. Create data loaders
-    loader_args = dict(batch_size=batch_size, num_workers=4, pin_memory=True)
-    train_loader = DataLoader(train_set, shuffle=False,**loader_args)
-    val_loader = DataLoader(val_set, shuffle=False, drop_last=True,**loader_args)
+              amp: bool = False,
+              accum_steps: int = 1,
+              log_flush_every: int = 5,
+              compiled: bool = False):
+    # under DDP the attributes and weights live on the wrapped module
+    model = net.module if isinstance(net, DistributedDataParallel) else net
+    is_main_process = not dist.is_initialized() or dist.get_rank() == 0
+
+    # 1. Train / validation partitions are the training and testing crops, built once by the caller
+    n_val = len(val_set)
+    n_train = len(train_set)
+
+    # every crop has the same HWC layout, so checking one sample is enough
+    n_image_channels = train_set[0]['image'].shape[-1]
+    assert n_image_channels == model.n_channels, \
+        f'Network has been defined with {model.n_channels} input channels, ' \
+        f'but loaded images have {n_image_channels} channels. Please check that ' \
+        'the images are loaded correctly.'
+
+    # 2. Create data loaders
+    # Keep workers alive across epochs and queue more batches so JPEG decoding keeps up with the GPU
+    loader_args = dict(batch_size=batch_size, num_workers=min(8, os.cpu_count() or 1), pin_memory=True,
+                       persistent_workers=True, prefetch_factor=4)
+    # each DDP rank trains on its own shard of the training set
+    train_sampler = DistributedSampler(train_set, shuffle=True) if dist.is_initialized() else None
+    # crops are a fixed 224x224, so with whole batches only the compiled graph never sees a new shape;
+    # a short last batch would trigger a second max-autotune compile and a dynamic-batch graph
+    train_loader = DataLoader(train_set, shuffle=False, sampler=train_sampler, drop_last=compiled, **loader_args)
+    # validation runs at sync points anyway, so it doesn't need to hold on to pinned host memory
+    val_loader = DataLoader(val_set, shuffle=False, drop_last=True, **dict(loader_args, pin_memory=False))
+    steps_per_epoch = max(1, len(train_loader.sampler) // batch_size)
+    n_train_per_epoch = len(train_loader) * batch_size if compiled else len(train_loader.sampler)
+    # refresh the progress bar ~100 times per epoch instead of after every batch
+    pbar_update_every = max(1, steps_per_epoch // 100)
+    # overlap the host-to-device copy of the next batch with the current step
+    train_batches = CUDAPrefetcher(train_loader, device) if device.type == 'cuda' else train_loader
 
     # (Initialize logging)
-    experiment = wandb.init(project='U-Net', reinit=True, anonymous='must', entity="sravanchittupalli")
-    experiment.config.update(dict(epochs=epochs, batch_size=batch_size, learning_rate=learning_rate,
-                                  val_percent=val_percent, save_checkpoint=save_checkpoint, img_scale=img_scale,
-                                  amp=amp))
+    experiment = init_experiment(is_main_process, dict(epochs=epochs, batch_size=batch_size,
+                                                       learning_rate=learning_rate, val_percent=val_percent,
+                                                       save_checkpoint=save_checkpoint, img_scale=img_scale,
+                                                       amp=amp, accum_steps=accum_steps))
 
     logging.info(f'''Starting training:
         Epochs:          {epochs}
@@ -75,52 +190,97 @@ def train_net(net,
         Device:          {device.type}
         Images scaling:  {img_scale}
         Mixed Precision: {amp}
+        Accum. steps:    {accum_steps}
     ''')
 
-    # 4. Set up the optimizer, the loss, the learning rate scheduler and the loss scaling for AMP
-    optimizer = optim.Adam(net.parameters(), lr=learning_rate, weight_decay=1e-8)#, momentum=0.9)
+    # 3. Set up the optimizer, the loss, the learning rate scheduler and the loss scaling for AMP
+    try:
+        # single fused CUDA kernel for the whole update instead of one launch per parameter tensor
+        optimizer = optim.Adam(net.parameters(), lr=learning_rate, weight_decay=1e-8, fused=True)
+    except (TypeError, RuntimeError):
+        # older PyTorch without `fused`, or parameters not on a device the fused kernel supports
+        optimizer = optim.Adam(net.parameters(), lr=learning_rate, weight_decay=1e-8, foreach=True)
     scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'max', patience=2)  # goal: maximize Dice score
-    grad_scaler = torch.cuda.amp.GradScaler(enabled=amp)
-    criterion = nn.BCELoss()
+    # BF16 keeps FP32's exponent range, so it needs no loss scaling; FP16 stays as fallback for older GPUs.
+    # is_bf16_supported() also counts emulated BF16 on V100/T4, so require native support (Ampere+)
+    use_bf16 = amp and device.type == 'cuda' and torch.cuda.get_device_capability(device)[0] >= 8
+    amp_dtype = torch.bfloat16 if use_bf16 else torch.float16
+    grad_scaler = torch.cuda.amp.GradScaler(enabled=amp and not use_bf16)
+    criterion = nn.BCEWithLogitsLoss()
     global_step = 0
 
-    # 5. Begin training
+    # checkpoints are written on a background thread so the GPU doesn't sit idle during torch.save
+    checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+    pending_checkpoint = None
+    if is_main_process:
+        Path(dir_checkpoint).mkdir(parents=True, exist_ok=True)
+
+    # 4. Begin training
     for epoch in range(epochs):
         net.train()
-        epoch_loss = 0
-        with tqdm(total=n_train, desc=f'Epoch {epoch + 1}/{epochs}', unit='img') as pbar:
-            for batch in train_loader:
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
+        # accumulate on the device so the loop never blocks on loss.item()
+        epoch_loss = torch.zeros((), device=device)
+        pbar_pending = 0
+        with tqdm(total=n_train_per_epoch, desc=f'Epoch {epoch + 1}/{epochs}', unit='img',
+                  mininterval=1.0) as pbar:
+            for step_idx, batch in enumerate(train_batches):
                 images = batch['image']
                 true_out = batch['output']
-                
-                assert images.shape[1] == net.n_channels, \
-                    f'Network has been defined with {net.n_channels} input channels, ' \
-                    f'but loaded images have {images.shape[1]} channels. Please check that ' \
-                    'the images are loaded correctly.'
-
-                images = images.to(device=device, dtype=torch.float32)
-                true_out = true_out.to(device=device, dtype=torch.float32)
-
-                with torch.cuda.amp.autocast(enabled=amp):
-                    pred = net(images)
-#                     print(pred, true_out)
-                    loss = criterion(pred, true_out)
-
-                optimizer.zero_grad(set_to_none=True)
-                grad_scaler.scale(loss).backward()
-                grad_scaler.step(optimizer)
-                grad_scaler.update()
-                epoch_loss += loss.item()
-
-                pbar.update(images.shape[0])
+
+                # crops stay raw HWC bytes until they reach the device (a quarter of the float32 transfer),
+                # the permuted NCHW view of an NHWC batch is already channels_last
+                images = images.to(device=device, non_blocking=True).permute(0, 3, 1, 2).float().div_(255)
+                true_out = true_out.to(device=device, dtype=torch.float32, non_blocking=True)
+                images = images.contiguous(memory_format=torch.channels_last)
+
+                # only step once every accum_steps micro-batches (and on the last one of the epoch)
+                should_step = (step_idx + 1) % accum_steps == 0 or step_idx + 1 == len(train_loader)
+                # the last window of an epoch can be shorter, average over the batches it really has
+                window_start = step_idx - step_idx % accum_steps
+                window_size = min(accum_steps, len(train_loader) - window_start)
+                # DDP doesn't need to all-reduce gradients that are still being accumulated
+                sync_context = net.no_sync() if model is not net and not should_step else nullcontext()
+
+                with sync_context:
+                    with torch.autocast('cuda', dtype=amp_dtype, enabled=amp):
+                        pred = net(images)
+#                         print(pred, true_out)
+                        loss = criterion(pred, true_out) / window_size
+
+                    if use_bf16:
+                        loss.backward()
+                    else:
+                        grad_scaler.scale(loss).backward()
+
+                if should_step:
+                    if use_bf16:
+                        optimizer.step()
+                    else:
+                        grad_scaler.step(optimizer)
+                        grad_scaler.update()
+                    optimizer.zero_grad(set_to_none=True)
+                epoch_loss += loss.detach() * window_size
+
+                pbar_pending += images.shape[0]
+                if (step_idx + 1) % pbar_update_every == 0:
+                    pbar.update(pbar_pending)
+                    pbar_pending = 0
             
+            pbar.update(pbar_pending)
             global_step += 1
+            epoch_loss_val = epoch_loss.item()
             experiment.log({
-                'train loss': epoch_loss/(n_train//batch_size),
+                'train loss': epoch_loss_val/steps_per_epoch,
                 'step': global_step,
                 'epoch': epoch
             })
-            pbar.set_postfix(**{'loss (epoch)': epoch_loss/(n_train//batch_size)})
+            pbar.set_postfix(**{'loss (epoch)': epoch_loss_val/steps_per_epoch})
+
+        # wandb serialisation and IPC only every few epochs
+        if (epoch + 1) % log_flush_every == 0:
+            experiment.flush()
 
         # Evaluation round
         # print(global_step, n_train, batch_size)
@@ -131,7 +291,7 @@ def train_net(net,
 #                 histograms['Weights/' + tag] = wandb.Histogram(value.data.cpu())
 #                 histograms['Gradients/' + tag] = wandb.Histogram(value.grad.data.cpu())
 
-#             val_score = evaluate(net, val_loader, device)
+#             val_score = evaluate(net, val_loader, device, amp, amp_dtype)
 #             scheduler.step(val_score)
 
 #             logging.info('Validation Dice score: {}'.format(val_score))
@@ -143,10 +303,23 @@ def train_net(net,
 #                 **histograms
 #             })
 
-        if (epoch%2 == 0):
-            Path(dir_checkpoint).mkdir(parents=True, exist_ok=True)
-            torch.save(net.state_dict(), str(dir_checkpoint / f'checkpoint_epoch_224x224_{epoch + 1}.pth'))
-            logging.info(f'Checkpoint {epoch + 1} saved!')
+        # hand the fragmented cached blocks back to the driver so the next epoch starts from a compact pool
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+        if (epoch%2 == 0) and is_main_process:
+            # re-raise any error from the previous save instead of losing it in the worker thread
+            if pending_checkpoint is not None:
+                pending_checkpoint.result()
+            # snapshot the weights now, training keeps updating them in place while the file is written
+            cpu_state = {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+            pending_checkpoint = checkpoint_executor.submit(
+                save_state_dict, cpu_state, dir_checkpoint / f'checkpoint_epoch_224x224_{epoch + 1}.pth', epoch + 1)
+
+    experiment.flush()
+    if pending_checkpoint is not None:
+        pending_checkpoint.result()
+    checkpoint_executor.shutdown()
 
 
 # -
@@ -162,17 +335,46 @@ def get_args():
     parser.add_argument('--validation', '-v', dest='val', type=float, default=10.0,
                         help='Percent of the data that is used as validation (0-100)')
     parser.add_argument('--amp', action='store_true', default=False, help='Use mixed precision')
+    parser.add_argument('--accum-steps', dest='accum_steps', metavar='N', type=int, default=1,
+                        help='Number of batches to accumulate gradients over before each optimizer step')
+    parser.add_argument('--precompute-cache', dest='precompute_cache', metavar='PATH', type=str, default=None,
+                        help='Directory of memory-mapped uint8 crop caches, built on first use')
+
+    args = parser.parse_args()
+    if args.accum_steps < 1:
+        parser.error(f'--accum-steps must be at least 1, got {args.accum_steps}')
 
-    return parser.parse_args()
+    return args
 
 
 if __name__ == '__main__':
     args = get_args()
+    # must be set before the first CUDA allocation to take effect
+    os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
+    # set WANDB_MODE=offline to log locally and `wandb sync` later
+    os.environ.setdefault('WANDB_MODE', 'online')
 
     logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
-    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    # torchrun sets LOCAL_RANK; a plain `python fyp_train.py` keeps training on a single device
+    distributed = 'LOCAL_RANK' in os.environ
+    if distributed:
+        local_rank = int(os.environ['LOCAL_RANK'])
+        dist.init_process_group('nccl')
+        torch.cuda.set_device(local_rank)
+        device = torch.device(f'cuda:{local_rank}')
+        # BasicDataset shuffles its ids, every rank must end up with the same order to shard it
+        random.seed(0)
+    else:
+        device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
     logging.info(f'Using device {device}')
 
+    # Input crops are always 224x224, so let cuDNN autotune once and use TF32 tensor cores for FP32 ops
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.deterministic = False
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision('high')
+
     # Change here to adapt to your data
     # n_channels=3 for RGB images
     # n_classes is the number of probabilities you want to get per pixel
@@ -187,16 +389,48 @@ if __name__ == '__main__':
         logging.info(f'Model loaded from {args.load}')
 
     net.to(device=device)
+    # NHWC lets cuDNN pick tensor-core conv kernels under AMP
+    net = net.to(memory_format=torch.channels_last)
+    model = DistributedDataParallel(net, device_ids=[local_rank]) if distributed else net
+    # Compiling the DDP wrapper lets dynamo split the graph at gradient bucket boundaries so the
+    # all-reduce still overlaps backward, and compiling in place keeps the state_dict keys unchanged.
+    # Only on CUDA: max-autotune on CPU needs a working C++ toolchain for Inductor.
+    compiled = device.type == 'cuda' and hasattr(model, 'compile')
+    if compiled:
+        model.compile(mode='max-autotune')
+    else:
+        logging.info('Not compiling the model (CPU device or no nn.Module.compile), running in eager mode')
+
+    # scan the dataset directories once and reuse the same objects for the whole run
+    if args.precompute_cache:
+        cache_dir = Path(args.precompute_cache)
+        dataset_training = load_cached_dataset(cache_dir / 'training.bin', dir_img_training, dir_mask_training,
+                                               args.scale)
+        dataset_testing = load_cached_dataset(cache_dir / 'testing.bin', dir_img_testing, dir_mask_testing,
+                                              args.scale)
+    else:
+        dataset_training = load_dataset(dir_img_training, dir_mask_training, args.scale)
+        dataset_testing = load_dataset(dir_img_testing, dir_mask_testing, args.scale)
+
     try:
-        train_net(net=net,
+        train_net(net=model,
+                  train_set=dataset_training,
+                  val_set=dataset_testing,
                   epochs=args.epochs,
                   batch_size=args.batch_size,
                   learning_rate=args.lr,
                   device=device,
                   img_scale=args.scale,
                   val_percent=args.val / 100,
-                  amp=args.amp)
+                  amp=args.amp,
+                  accum_steps=args.accum_steps,
+                  compiled=compiled)
     except KeyboardInterrupt:
-        torch.save(net.state_dict(), 'INTERRUPTED.pth')
-        logging.info('Saved interrupt')
+        # every rank gets the interrupt, only one of them may write the file
+        if not distributed or dist.get_rank() == 0:
+            torch.save(net.state_dict(), 'INTERRUPTED.pth')
+            logging.info('Saved interrupt')
         sys.exit(0)
+    finally:
+        if distributed:
+            dist.destroy_process_group()
@@ -36,6 +36,7 @@ class UNet(nn.Module):
         classification_part = torch.flatten(classification_part, start_dim=1)
         classification_part = F.relu(self.linear_1(classification_part))
 #         classification_part = F.relu(self.linear_2(classification_part))
-        classification_result = torch.sigmoid(self.linear_2(classification_part))
+        # raw logits, the sigmoid is fused into BCEWithLogitsLoss during training
+        classification_result = self.linear_2(classification_part)
 
         return classification_result
@@ -39,7 +39,8 @@ class BasicDataset(Dataset):
         #newW, newH = int(scale * w), int(scale * h)
         newW,newH = 224,224
         assert newW > 0 and newH > 0, 'Scale is too small, resized images would have no pixel'
-        pil_img = pil_img.resize((newW, newH))
+        if pil_img.size != (newW, newH):
+            pil_img = pil_img.resize((newW, newH))
         img_ndarray = np.asarray(pil_img)
 
 
@@ -49,7 +50,21 @@ class BasicDataset(Dataset):
             img_ndarray = img_ndarray.transpose((2, 0, 1))
 
         if not is_mask:
-            img_ndarray = img_ndarray / 255
+            # single contiguous float32 copy that torch.from_numpy can wrap as is
+            img_ndarray = np.ascontiguousarray(img_ndarray, dtype=np.float32)
+            img_ndarray /= 255
+
+        return img_ndarray
+
+    @classmethod
+    def preprocess_uint8(cls, pil_img, size=(224, 224)):
+        # raw HWC bytes, the float conversion and scaling happen on the GPU
+        if pil_img.size != size:
+            pil_img = pil_img.resize(size)
+        img_ndarray = np.array(pil_img)
+
+        if img_ndarray.ndim == 2:
+            img_ndarray = img_ndarray[..., np.newaxis]
 
         return img_ndarray
 
@@ -63,8 +78,7 @@ class BasicDataset(Dataset):
         else:
             return Image.open(filename).resize((224,224),Image.NEAREST)
 
-    def __getitem__(self, idx):
-        name = self.ids[idx]
+    def load_sample(self, name):
         vdo_name = name.split('_')[0]
         if self.file[vdo_name+'.mp4']['label'] == 'REAL':
             true_out = np.array([1])
@@ -80,14 +94,119 @@ class BasicDataset(Dataset):
 
             img = self.load(img_file)
 
-        img = self.preprocess(img, self.scale, is_mask=False)
+        return img, true_out
+
+    def __getitem__(self, idx):
+        img, true_out = self.load_sample(self.ids[idx])
+        img = self.preprocess_uint8(img)
 
         return {
-            'image': torch.as_tensor(img.copy()).float().contiguous(),
-            'output': torch.as_tensor(true_out.copy()).long().contiguous()
+            'image': torch.from_numpy(img),
+            'output': torch.from_numpy(true_out).long()
         }
 
 
 class CarvanaDataset(BasicDataset):
     def __init__(self, images_dir, masks_dir, scale=1):
         super().__init__(images_dir, masks_dir, scale, mask_suffix='_mask')
+
+
+class CachedDataset(Dataset):
+    """Decoded uint8 crops from a BasicDataset, memory-mapped from a single file written by CachedDataset.build"""
+    crop_size = 224
+
+    def __init__(self, memmap_path):
+        self.memmap_path = Path(memmap_path)
+        self.labels = np.load(self.labels_path(self.memmap_path))
+        # mapped lazily so each DataLoader worker opens its own view instead of pickling the array
+        self.images = None
+        logging.info(f'Loaded cached dataset with {len(self.labels)} examples from {self.memmap_path}')
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getstate__(self):
+        # under spawn/forkserver pickling the np.memmap would copy the whole cache into every worker,
+        # drop it so each worker maps the file itself on first access
+        state = self.__dict__.copy()
+        state['images'] = None
+        return state
+
+    @staticmethod
+    def labels_path(memmap_path):
+        return Path(memmap_path).with_suffix('.labels.npy')
+
+    @classmethod
+    def build(cls, dataset: BasicDataset, memmap_path):
+        """Decodes every crop of `dataset` once and writes them as [N, H, W, 3] uint8 plus an [N, 1] label array"""
+        memmap_path = Path(memmap_path)
+        memmap_path.parent.mkdir(parents=True, exist_ok=True)
+        # write next to the target and rename at the end, so an interrupted build is never picked up
+        tmp_path = memmap_path.with_suffix('.tmp')
+        images = np.memmap(tmp_path, dtype=np.uint8, mode='w+',
+                           shape=(len(dataset), cls.crop_size, cls.crop_size, 3))
+        labels = np.empty((len(dataset), 1), dtype=np.int64)
+
+        for idx, name in enumerate(dataset.ids):
+            img, true_out = dataset.load_sample(name)
+            images[idx] = dataset.preprocess_uint8(img.convert('RGB'), (cls.crop_size, cls.crop_size))
+            labels[idx] = true_out
+
+        images.flush()
+        del images
+        np.save(cls.labels_path(memmap_path), labels)
+        tmp_path.replace(memmap_path)
+        logging.info(f'Cached {len(labels)} examples to {memmap_path}')
+        return cls(memmap_path)
+
+    def __getitem__(self, idx):
+        if self.images is None:
+            # copy-on-write mapping, so torch.from_numpy gets a writable array without reading the file eagerly
+            self.images = np.memmap(self.memmap_path, dtype=np.uint8, mode='c',
+                                    shape=(len(self.labels), self.crop_size, self.crop_size, 3))
+        return {
+            'image': torch.from_numpy(self.images[idx]),
+            'output': torch.from_numpy(self.labels[idx])
+        }
+
+
+class CUDAPrefetcher:
+    """Wraps a DataLoader and copies the next batch to the GPU on a side stream while the current one is used"""
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+        self.next_batch = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.preload()
+        return self
+
+    def preload(self):
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.next_batch = None
+            return
+
+        with torch.cuda.stream(self.stream):
+            self.next_batch = {k: v.to(self.device, non_blocking=True) for k, v in batch.items()}
+
+    def __next__(self):
+        if self.next_batch is None:
+            raise StopIteration
+
+        compute_stream = torch.cuda.current_stream(self.device)
+        compute_stream.wait_stream(self.stream)
+        batch = self.next_batch
+        # the tensors were allocated on the side stream, keep the allocator from reusing them too early
+        for tensor in batch.values():
+            tensor.record_stream(compute_stream)
+
+        self.preload()
+        return batch